@@ -1,23 +1,72 @@
 # OneZone.py: simple one-zone chemical evolution models
 from functools import wraps
+from collections import OrderedDict
+import copy
+import os
+import math
+import struct
 import numpy
-from scipy import optimize
-import hashlib
 from astropy import units as u
+from . import __version__
+try:
+    from numba import njit
+except ImportError: # pragma: no cover
+    _NUMBA_LOADED= False
+else:
+    _NUMBA_LOADED= True
+try:
+    import xxhash
+except ImportError: # pragma: no cover
+    _XXHASH_LOADED= False
+else:
+    _XXHASH_LOADED= True
+try:
+    from . import _kernels
+except ImportError: # pragma: no cover
+    _KERNELS_LOADED= False
+else:
+    _KERNELS_LOADED= True
+def _digest(data):
+    # Integer digest of bytes, using xxhash when available
+    if _XXHASH_LOADED:
+        return xxhash.xxh3_64_intdigest(data)
+    return hash(data)
+
+# Maximum number of MDFs memoized in memory for a model, and the version of
+# the format of the on-disk cache of MDFs, which should be increased whenever
+# the computed MDFs change
+_DF_CACHE_SIZE= 128
+_DF_CACHE_FORMAT= 1
+def _combine_scalar_evol(Z_eq,evol_CC,evol_Ia):
+    # Total abundances from (CC,(Ia,...)) equilibrium abundances of elements
+    # and the time evolution of the CC and all Ia components, as floats
+    out= []
+    for Z_CC,Z_Ia in Z_eq:
+        Z= Z_CC*evol_CC
+        for Z_Ia_jj,evol_Ia_jj in zip(Z_Ia,evol_Ia):
+            Z+= Z_Ia_jj*evol_Ia_jj
+        out.append(Z)
+    return out
+
 def _recalc_model(method):
     @wraps(method)
     def wrapper(*args,**kwargs):
-        new_model_hash= args[0]._model_hash()
-        if new_model_hash != args[0]._current_model_hash:
+        if args[0]._dirty_model:
             args[0]._update_timescales()
             args[0]._calc_equilibrium()
-            args[0]._current_model_hash= new_model_hash
-        new_solar_hash= args[0]._solar_hash()
-        if new_solar_hash != args[0]._current_solar_hash:
-            args[0]._calc_solar()
-            args[0]._current_solar_hash= new_solar_hash
+            args[0]._current_model_hash= args[0]._model_hash()
+            args[0]._dirty_model= False
         return method(*args,**kwargs)
     return wrapper   
+
+def _as_gyr(t):
+    # Times as a float or float array in Gyr, from a Quantity or from a
+    # float or array that is already in Gyr
+    if hasattr(t,'unit'):
+        t= t.to_value(u.Gyr)
+    if isinstance(t,float): return t
+    t= numpy.asarray(t,dtype='float64')
+    return float(t) if t.ndim == 0 else t
 _defaults= {'eta':2.5,
             'tau_SFE':   1.*u.Gyr,
             'tau_SFH':   6.*u.Gyr,
@@ -33,8 +82,78 @@ _defaults= {'eta':2.5,
             'frac_Ia_2': 0.522,
             'solar_O':   8.69,
             'solar_Fe':  7.47}
+_solar_keys= ['solar_O','solar_Fe']
+if _NUMBA_LOADED:
+    # JIT-compiled kernels for the total abundances of elements, used
+    # instead of the numpy implementations in OneZone when numba is available;
+    # t is a 1D array, Z_CC_eq is an array over elements, Z_Ia_eq is a 2D
+    # array over elements and Ia components, tau_dep_Ia and tau_Ia_SFH are
+    # arrays over Ia components, and all times are in Gyr
+    @njit(cache=True,fastmath=True,error_model='numpy')
+    def _Z_total_exp_jit(t,min_dt_Ia,tau_dep_SFH,Z_CC_eq,
+                         Z_Ia_eq,tau_dep_Ia,tau_Ia_SFH):
+        out= numpy.empty((Z_CC_eq.shape[0],t.shape[0]))
+        for ii in range(t.shape[0]):
+            evol_CC= -numpy.expm1(-t[ii]/tau_dep_SFH)
+            for kk in range(Z_CC_eq.shape[0]):
+                out[kk,ii]= Z_CC_eq[kk]*evol_CC
+            dt= t[ii]-min_dt_Ia
+            if dt > 0.:
+                expm1_dep_SFH= numpy.expm1(-dt/tau_dep_SFH)
+                for jj in range(Z_Ia_eq.shape[1]):
+                    evol_Ia= -expm1_dep_SFH-tau_dep_Ia[jj]/tau_dep_SFH\
+                        *(numpy.expm1(-dt/tau_Ia_SFH[jj])-expm1_dep_SFH)
+                    for kk in range(Z_CC_eq.shape[0]):
+                        out[kk,ii]+= Z_Ia_eq[kk,jj]*evol_Ia
+        return out
+
+    @njit(cache=True,fastmath=True,error_model='numpy')
+    def _Z_total_linexp_jit(t,min_dt_Ia,tau_dep_SFH,Z_CC_eq,
+                            Z_Ia_eq,tau_dep_Ia,tau_Ia_SFH):
+        out= numpy.empty((Z_CC_eq.shape[0],t.shape[0]))
+        for ii in range(t.shape[0]):
+            evol_CC= 1.+tau_dep_SFH/t[ii]*numpy.expm1(-t[ii]/tau_dep_SFH)
+            for kk in range(Z_CC_eq.shape[0]):
+                out[kk,ii]= Z_CC_eq[kk]*evol_CC
+            dt= t[ii]-min_dt_Ia
+            if dt > 0.:
+                expm1_dep_SFH= numpy.expm1(-dt/tau_dep_SFH)
+                for jj in range(Z_Ia_eq.shape[1]):
+                    evol_Ia= tau_Ia_SFH[jj]/t[ii]\
+                        *(dt/tau_Ia_SFH[jj]+tau_dep_Ia[jj]/tau_dep_SFH
+                          *numpy.expm1(-dt/tau_Ia_SFH[jj])
+                          +(1.+tau_dep_SFH/tau_Ia_SFH[jj]
+                            -tau_dep_Ia[jj]/tau_dep_SFH)*expm1_dep_SFH)
+                    for kk in range(Z_CC_eq.shape[0]):
+                        out[kk,ii]+= Z_Ia_eq[kk,jj]*evol_Ia
+        return out
+# Compiled kernels used by OneZone: the ahead-of-time compiled extension when
+# it was built, the numba kernels otherwise, or None to use numpy
+if _KERNELS_LOADED:
+    _Z_total_exp_kernel= _kernels.Z_total_exp
+    _Z_total_linexp_kernel= _kernels.Z_total_linexp
+elif _NUMBA_LOADED:
+    _Z_total_exp_kernel= _Z_total_exp_jit
+    _Z_total_linexp_kernel= _Z_total_linexp_jit
+else:
+    _Z_total_exp_kernel= None
+    _Z_total_linexp_kernel= None
 class OneZone(object):
     """OneZone: simple one-zone chemical evolution models"""
+    # Store the parameters and all derived quantities in slots, for fast
+    # attribute access in the model evaluations
+    __slots__= tuple(_defaults.keys())\
+        +('_init_params','_dirty_model','_dirty_solar',
+          '_current_model_hash','_inverse_tables','_DF_cache',
+          '_tau_SFE_gyr','_tau_SFH_gyr','_tau_Ia_gyr','_min_dt_Ia_gyr',
+          '_tau_Ia_2_gyr','_tau_dep','_tau_dep_SFH','_tau_dep_Ia',
+          '_tau_Ia_SFH','_tau_dep_Ia_2','_tau_Ia_SFH_2','_tau_dep_Ia_all',
+          '_tau_Ia_SFH_all','_tau_Ia_floats','_sfh_is_exp','_Z_total_impl',
+          '_Z_total_scalar_impl','_dZ_total_dt_impl',
+          '_ZO_CC_eq','_ZO_Ia_eq','_ZFe_CC_eq','_ZFe_Ia_eq',
+          '_ZO_Ia_eq_2','_ZFe_Ia_eq_2','_Z_CC_eq_all','_Z_Ia_eq_all',
+          '_ZO_eq','_ZFe_eq','_Z_eq_all',
+          '_logZO_solar_cache','_logZFe_solar_cache')
     def __init__(self,**kwargs):
         """
         NAME:
@@ -64,195 +183,510 @@ class OneZone(object):
            2018-07-09 - Written - Bovy (UofT)
            2018-11-01 - Added second Ia component for approximxating t^{-1.1} decay distribution - Bovy (UofT)
         """
+        # Setting the parameters flags the model and solar abundances as
+        # needing to be (re-)computed, which happens upon first use
         self._initialize_params(**kwargs)
         # Setup hash for storing models
         self._current_model_hash= None
-        self._current_solar_hash= None
+        # Tables for inverting the abundances as a function of time
+        self._inverse_tables= {}
+        # MDFs of arrays computed for the current model, (hash,{entry: MDF})
+        self._DF_cache= (None,OrderedDict())
+        return None
+
+    def __setattr__(self,name,value):
+        # Flag the model or the solar abundances as needing to be re-computed
+        # when any of their parameters is set
+        if name in _solar_keys:
+            object.__setattr__(self,'_dirty_solar',True)
+        elif name in _defaults:
+            object.__setattr__(self,'_dirty_model',True)
+        object.__setattr__(self,name,value)
         return None
 
+    # Parameters are always stored as copies, such that in-place changes
+    # (e.g., oz.tau_SFE*= 2) do not leak to the defaults, the initial
+    # parameters, or other instances, which would not be flagged as dirty
     def _initialize_params(self,**kwargs):
         self._init_params= {} # To store initial
         for key in _defaults.keys():
-            self.__dict__[key]= kwargs.get(key,_defaults[key])
-            self._init_params[key]= kwargs.get(key,_defaults[key])
+            setattr(self,key,copy.copy(kwargs.get(key,_defaults[key])))
+            self._init_params[key]= copy.copy(kwargs.get(key,_defaults[key]))
         return None
 
     def initial(self):
         for key in _defaults.keys():
-            self.__dict__[key]= self._init_params[key]
+            setattr(self,key,copy.copy(self._init_params[key]))
         return None
 
     def default(self):
         for key in _defaults.keys():
-            self.__dict__[key]= _defaults[key]
+            setattr(self,key,copy.copy(_defaults[key]))
         return None
 
     def __str__(self):
         out= ''
         for key in sorted(_defaults.keys()):
-            out+= '{0:<10}:\t{1}\n'.format(key,self.__dict__[key])
+            out+= '{0:<10}:\t{1}\n'.format(key,getattr(self,key))
         return out[:-1]
 
     def _calc_solar(self):
-        self._logZO_solar= -2.25+self.solar_O-8.69
-        self._logZFe_solar= -2.93+self.solar_Fe-7.47
+        self._logZO_solar_cache= -2.25+self.solar_O-8.69
+        self._logZFe_solar_cache= -2.93+self.solar_Fe-7.47
+        self._dirty_solar= False
         return None
 
+    # Solar abundances, only re-computed when solar_O or solar_Fe are set
+    @property
+    def _logZO_solar(self):
+        if self._dirty_solar: self._calc_solar()
+        return self._logZO_solar_cache
+
+    @property
+    def _logZFe_solar(self):
+        if self._dirty_solar: self._calc_solar()
+        return self._logZFe_solar_cache
+
     # Equilibrium and model parameters
+    def _refresh_scalars(self):
+        # Cache the model's timescales as plain floats in Gyr, such that the
+        # model computations can avoid Quantity overhead
+        self._tau_SFE_gyr= float(self.tau_SFE.to_value(u.Gyr))
+        self._tau_SFH_gyr= float(self.tau_SFH.to_value(u.Gyr))
+        self._tau_Ia_gyr= float(self.tau_Ia.to_value(u.Gyr))
+        self._min_dt_Ia_gyr= float(self.min_dt_Ia.to_value(u.Gyr))
+        if self.tau_Ia_2 is None:
+            self._tau_Ia_2_gyr= None
+        else:
+            self._tau_Ia_2_gyr= float(self.tau_Ia_2.to_value(u.Gyr))
+        return None
+
     def _update_timescales(self):
         # Update all relevant timescales for the model based on the current
-        # model parameters
-        self._tau_dep= self.tau_SFE/(1.+self.eta-self.r)
-        self._tau_dep_SFH= 1./(1./self._tau_dep-1./self.tau_SFH)
-        self._tau_dep_Ia= 1./(1./self._tau_dep-1./self.tau_Ia)
-        self._tau_Ia_SFH= 1./(1./self.tau_Ia-1./self.tau_SFH)
+        # model parameters; all timescales are plain floats in Gyr
+        self._refresh_scalars()
+        self._tau_dep= self._tau_SFE_gyr/(1.+self.eta-self.r)
+        self._tau_dep_SFH= 1./(1./self._tau_dep-1./self._tau_SFH_gyr)
+        self._tau_dep_Ia= 1./(1./self._tau_dep-1./self._tau_Ia_gyr)
+        self._tau_Ia_SFH= 1./(1./self._tau_Ia_gyr-1./self._tau_SFH_gyr)
+        # Also store arrays over all Ia components for the time evolution
+        tau_dep_Ia_all= [self._tau_dep_Ia]
+        tau_Ia_SFH_all= [self._tau_Ia_SFH]
         if not self.tau_Ia_2 is None:
-            self._tau_dep_Ia_2= 1./(1./self._tau_dep-1./self.tau_Ia_2)
-            self._tau_Ia_SFH_2= 1./(1./self.tau_Ia_2-1./self.tau_SFH)
+            self._tau_dep_Ia_2= 1./(1./self._tau_dep-1./self._tau_Ia_2_gyr)
+            self._tau_Ia_SFH_2= 1./(1./self._tau_Ia_2_gyr-1./self._tau_SFH_gyr)
+            tau_dep_Ia_all.append(self._tau_dep_Ia_2)
+            tau_Ia_SFH_all.append(self._tau_Ia_SFH_2)
+        self._tau_dep_Ia_all= numpy.array(tau_dep_Ia_all)
+        self._tau_Ia_SFH_all= numpy.array(tau_Ia_SFH_all)
+        # and (tau_dep_Ia,tau_Ia_SFH) float pairs for the scalar evaluations
+        self._tau_Ia_floats= tuple(zip(tau_dep_Ia_all,tau_Ia_SFH_all))
+        # Resolve the type of SFH once, by binding the time-evolution
+        # equations for this SFH
+        self._sfh_is_exp= self.sfh.lower() == 'exp'
+        if self._sfh_is_exp:
+            self._Z_total_impl= self._Z_total_exp
+            self._Z_total_scalar_impl= self._Z_total_exp_scalar
+            self._dZ_total_dt_impl= self._dZ_total_dt_exp
+        else:
+            self._Z_total_impl= self._Z_total_linexp
+            self._Z_total_scalar_impl= self._Z_total_linexp_scalar
+            self._dZ_total_dt_impl= self._dZ_total_dt_linexp
         return None
 
     def _calc_equilibrium(self):
-        self._ZO_CC_eq= self.mCC_O*self._tau_dep_SFH/self.tau_SFE
-        self._ZO_Ia_eq= self.mIa_O*self._tau_dep_SFH/self.tau_SFE\
-            *self._tau_Ia_SFH/self.tau_Ia\
-            *numpy.exp(self.min_dt_Ia/self.tau_SFH)
-        self._ZFe_CC_eq= self.mCC_Fe*self._tau_dep_SFH/self.tau_SFE
-        self._ZFe_Ia_eq= self.mIa_Fe*self._tau_dep_SFH/self.tau_SFE\
-            *self._tau_Ia_SFH/self.tau_Ia\
-            *numpy.exp(self.min_dt_Ia/self.tau_SFH)
+        # Factors shared between the equilibrium abundances
+        dep_ratio= self._tau_dep_SFH/self._tau_SFE_gyr
+        exp_factor= numpy.exp(self._min_dt_Ia_gyr/self._tau_SFH_gyr)
+        Ia_factor= dep_ratio*self._tau_Ia_SFH/self._tau_Ia_gyr*exp_factor
+        if not self.tau_Ia_2 is None:
+            Ia_factor*= (1.-self.frac_Ia_2)
+        self._ZO_CC_eq= self.mCC_O*dep_ratio
+        self._ZO_Ia_eq= self.mIa_O*Ia_factor
+        self._ZFe_CC_eq= self.mCC_Fe*dep_ratio
+        self._ZFe_Ia_eq= self.mIa_Fe*Ia_factor
         if not self.tau_Ia_2 is None:
-            self._ZO_Ia_eq*= (1.-self.frac_Ia_2)
-            self._ZFe_Ia_eq*= (1.-self.frac_Ia_2)
-            self._ZO_Ia_eq_2= self.frac_Ia_2*self.mIa_O\
-                *self._tau_dep_SFH/self.tau_SFE\
-                *self._tau_Ia_SFH_2/self.tau_Ia_2\
-                *numpy.exp(self.min_dt_Ia/self.tau_SFH)
-            self._ZFe_Ia_eq_2= self.frac_Ia_2*self.mIa_Fe\
-                *self._tau_dep_SFH/self.tau_SFE\
-                *self._tau_Ia_SFH_2/self.tau_Ia_2\
-                *numpy.exp(self.min_dt_Ia/self.tau_SFH)
+            Ia_factor_2= self.frac_Ia_2*dep_ratio\
+                *self._tau_Ia_SFH_2/self._tau_Ia_2_gyr*exp_factor
+            self._ZO_Ia_eq_2= self.mIa_O*Ia_factor_2
+            self._ZFe_Ia_eq_2= self.mIa_Fe*Ia_factor_2
+            self._Z_Ia_eq_all= numpy.array([[self._ZO_Ia_eq,self._ZO_Ia_eq_2],
+                                            [self._ZFe_Ia_eq,
+                                             self._ZFe_Ia_eq_2]])
+        else:
+            self._Z_Ia_eq_all= numpy.array([[self._ZO_Ia_eq],
+                                            [self._ZFe_Ia_eq]])
+        # Arrays over elements (O,Fe) and Ia components for the time
+        # evolution, the same as (CC,(Ia,...)) plain floats for each element
+        # for the scalar evaluations, and the (CC,Ia,floats) triplets of
+        # these for single elements
+        self._Z_CC_eq_all= numpy.array([self._ZO_CC_eq,self._ZFe_CC_eq])
+        Z_eq_floats= tuple((float(Z_CC),tuple(float(Z_Ia) for Z_Ia in Z_Ia_row))
+                           for Z_CC,Z_Ia_row in zip(self._Z_CC_eq_all,
+                                                    self._Z_Ia_eq_all))
+        self._ZO_eq= (self._Z_CC_eq_all[:1],self._Z_Ia_eq_all[:1],
+                      Z_eq_floats[:1])
+        self._ZFe_eq= (self._Z_CC_eq_all[1:],self._Z_Ia_eq_all[1:],
+                       Z_eq_floats[1:])
+        self._Z_eq_all= (self._Z_CC_eq_all,self._Z_Ia_eq_all,Z_eq_floats)
         return None
 
-    # Time evolution equations
-    def _evol_CC(self,t):
-        if self.sfh.lower() == 'exp':
-            return (1.-numpy.exp(-t/self._tau_dep_SFH))
-        else:
-            return (1.-self._tau_dep_SFH/t
-                       *(1.-numpy.exp(-t/self._tau_dep_SFH)))
-    
-    def _evol_Ia(self,t,tau_dep_Ia,tau_Ia_SFH):
-        # Ia contribution
-        dt= t-self.min_dt_Ia
+    # Time evolution equations, t and all timescales are floats in Gyr;
+    # Z_CC_eq is an array over elements and Z_Ia_eq a 2D array over elements
+    # and Ia components, such that multiple elements are computed together,
+    # and Z_eq_floats are the same as plain floats for scalar t
+    def _Z_total(self,t,Z_CC_eq,Z_Ia_eq,Z_eq_floats):
+        # Total abundances of elements, computing the CC and all Ia
+        # contributions in a single pass that shares the exponentials
+        if isinstance(t,float): # includes numpy.float64
+            return self._Z_total_scalar_impl(float(t),Z_eq_floats)
+        return self._Z_total_impl(\
+            numpy.ravel(numpy.asarray(t,dtype='float64')),
+            Z_CC_eq,Z_Ia_eq).reshape((len(Z_CC_eq),)+numpy.shape(t))
+
+    def _dZ_total_dt(self,t,Z_CC_eq,Z_Ia_eq,Z_eq_floats):
+        # Analytic time derivative of _Z_total
+        return self._dZ_total_dt_impl(\
+            numpy.ravel(numpy.asarray(t,dtype='float64')),
+            Z_CC_eq,Z_Ia_eq).reshape((len(Z_CC_eq),)+numpy.shape(t))
+
+    def _evol_expm1s(self,t):
+        # exp(-x)-1 factors shared between the CC and Ia contributions, as
+        # well as the times after the minimum Ia delay where Ias contribute;
+        # using expm1 avoids cancellation when t is small
+        expm1_dep_SFH= numpy.expm1(-t/self._tau_dep_SFH)
+        dt= t-self._min_dt_Ia_gyr
         idx= dt > 0.
-        out= numpy.zeros(t.shape)
-        if self.sfh.lower() == 'exp':
-            out[idx]+= \
-                (1.-numpy.exp(-dt[idx]/self._tau_dep_SFH)
-                                -tau_dep_Ia/self._tau_dep_SFH
-                                *(numpy.exp(-dt[idx]/tau_Ia_SFH)
-                                  -numpy.exp(-dt[idx]/self._tau_dep_SFH)))\
-                                  .to(u.dimensionless_unscaled).value
-        else:
-            out[idx]+= \
-                (tau_Ia_SFH/t[idx]\
-                *(dt[idx]/tau_Ia_SFH+tau_dep_Ia/self._tau_dep_SFH
-                                         *numpy.exp(-dt[idx]/tau_Ia_SFH)
+        dt= dt[idx]
+        return expm1_dep_SFH,idx,dt,numpy.expm1(-dt/self._tau_dep_SFH)
+
+    def _Z_total_exp(self,t,Z_CC_eq,Z_Ia_eq):
+        if not _Z_total_exp_kernel is None:
+            return _Z_total_exp_kernel(t,self._min_dt_Ia_gyr,
+                                       self._tau_dep_SFH,
+                                       Z_CC_eq,Z_Ia_eq,self._tau_dep_Ia_all,
+                                       self._tau_Ia_SFH_all)
+        expm1_dep_SFH,idx,dt,expm1_dt_dep_SFH= self._evol_expm1s(t)
+        out= -numpy.outer(Z_CC_eq,expm1_dep_SFH)
+        # Accumulate all Ia components at the masked times, such that the
+        # masked output is only updated once
+        out_Ia= numpy.zeros((len(Z_CC_eq),len(dt)))
+        for Z_Ia,tau_dep_Ia,tau_Ia_SFH in zip(Z_Ia_eq.T,
+                                             self._tau_dep_Ia_all,
+                                             self._tau_Ia_SFH_all):
+            out_Ia-= numpy.outer(Z_Ia,
+                                 expm1_dt_dep_SFH+tau_dep_Ia/self._tau_dep_SFH
+                                 *(numpy.expm1(-dt/tau_Ia_SFH)
+                                   -expm1_dt_dep_SFH))
+        out[:,idx]+= out_Ia
+        return out
+
+    def _Z_total_linexp(self,t,Z_CC_eq,Z_Ia_eq):
+        if not _Z_total_linexp_kernel is None:
+            return _Z_total_linexp_kernel(t,self._min_dt_Ia_gyr,
+                                          self._tau_dep_SFH,
+                                          Z_CC_eq,Z_Ia_eq,
+                                          self._tau_dep_Ia_all,
+                                          self._tau_Ia_SFH_all)
+        expm1_dep_SFH,idx,dt,expm1_dt_dep_SFH= self._evol_expm1s(t)
+        out= numpy.outer(Z_CC_eq,1.+self._tau_dep_SFH/t*expm1_dep_SFH)
+        tIa= t[idx]
+        out_Ia= numpy.zeros((len(Z_CC_eq),len(dt)))
+        for Z_Ia,tau_dep_Ia,tau_Ia_SFH in zip(Z_Ia_eq.T,
+                                             self._tau_dep_Ia_all,
+                                             self._tau_Ia_SFH_all):
+            out_Ia+= numpy.outer(Z_Ia*tau_Ia_SFH,
+                                 dt/tau_Ia_SFH+tau_dep_Ia/self._tau_dep_SFH
+                                 *numpy.expm1(-dt/tau_Ia_SFH)
+                                 +(1.+self._tau_dep_SFH/tau_Ia_SFH
+                                   -tau_dep_Ia/self._tau_dep_SFH)
+                                 *expm1_dt_dep_SFH)
+        out[:,idx]+= out_Ia/tIa
+        return out
+
+    # Scalar versions of the above, which only use plain floats and math to
+    # avoid all array overhead; these return a list over elements
+    def _Z_total_exp_scalar(self,t,Z_eq):
+        evol_CC= -math.expm1(-t/self._tau_dep_SFH)
+        dt= t-self._min_dt_Ia_gyr
+        evol_Ia= []
+        if dt > 0.:
+            expm1_dt_dep_SFH= math.expm1(-dt/self._tau_dep_SFH)
+            for tau_dep_Ia,tau_Ia_SFH in self._tau_Ia_floats:
+                evol_Ia.append(-expm1_dt_dep_SFH-tau_dep_Ia/self._tau_dep_SFH
+                               *(math.expm1(-dt/tau_Ia_SFH)-expm1_dt_dep_SFH))
+        return _combine_scalar_evol(Z_eq,evol_CC,evol_Ia)
+
+    def _Z_total_linexp_scalar(self,t,Z_eq):
+        # NaN at t=0 like the array versions
+        if t == 0.: return [math.nan]*len(Z_eq)
+        evol_CC= 1.+self._tau_dep_SFH/t*math.expm1(-t/self._tau_dep_SFH)
+        dt= t-self._min_dt_Ia_gyr
+        evol_Ia= []
+        if dt > 0.:
+            expm1_dt_dep_SFH= math.expm1(-dt/self._tau_dep_SFH)
+            for tau_dep_Ia,tau_Ia_SFH in self._tau_Ia_floats:
+                evol_Ia.append(tau_Ia_SFH/t
+                               *(dt/tau_Ia_SFH+tau_dep_Ia/self._tau_dep_SFH
+                                 *math.expm1(-dt/tau_Ia_SFH)
+                                 +(1.+self._tau_dep_SFH/tau_Ia_SFH
+                                   -tau_dep_Ia/self._tau_dep_SFH)
+                                 *expm1_dt_dep_SFH))
+        return _combine_scalar_evol(Z_eq,evol_CC,evol_Ia)
+
+    def _dZ_total_dt_exp(self,t,Z_CC_eq,Z_Ia_eq):
+        expm1_dep_SFH,idx,dt,expm1_dt_dep_SFH= self._evol_expm1s(t)
+        out= numpy.outer(Z_CC_eq,(1.+expm1_dep_SFH)/self._tau_dep_SFH)
+        out_Ia= numpy.zeros((len(Z_CC_eq),len(dt)))
+        for Z_Ia,tau_dep_Ia,tau_Ia_SFH in zip(Z_Ia_eq.T,
+                                             self._tau_dep_Ia_all,
+                                             self._tau_Ia_SFH_all):
+            out_Ia+= numpy.outer(Z_Ia,
+                                 (1.+expm1_dt_dep_SFH)/self._tau_dep_SFH
+                                 +tau_dep_Ia/self._tau_dep_SFH
+                                 *(numpy.exp(-dt/tau_Ia_SFH)/tau_Ia_SFH
+                                   -(1.+expm1_dt_dep_SFH)/self._tau_dep_SFH))
+        out[:,idx]+= out_Ia
+        return out
+
+    def _dZ_total_dt_linexp(self,t,Z_CC_eq,Z_Ia_eq):
+        expm1_dep_SFH,idx,dt,expm1_dt_dep_SFH= self._evol_expm1s(t)
+        out= -numpy.outer(Z_CC_eq,self._tau_dep_SFH/t**2.*expm1_dep_SFH
+                          +(1.+expm1_dep_SFH)/t)
+        tIa= t[idx]
+        out_Ia= numpy.zeros((len(Z_CC_eq),len(dt)))
+        for Z_Ia,tau_dep_Ia,tau_Ia_SFH in zip(Z_Ia_eq.T,
+                                             self._tau_dep_Ia_all,
+                                             self._tau_Ia_SFH_all):
+            expm1_dt_Ia_SFH= numpy.expm1(-dt/tau_Ia_SFH)
+            evol_Ia= tau_Ia_SFH/tIa\
+                *(dt/tau_Ia_SFH+tau_dep_Ia/self._tau_dep_SFH
+                  *expm1_dt_Ia_SFH
                   +(1.+self._tau_dep_SFH/tau_Ia_SFH
-                    -tau_dep_Ia/self._tau_dep_SFH)\
-                      *numpy.exp(-dt[idx]/self._tau_dep_SFH)
-                  -(1.+self._tau_dep_SFH/tau_Ia_SFH)))\
-                  .to(u.dimensionless_unscaled).value
+                    -tau_dep_Ia/self._tau_dep_SFH)*expm1_dt_dep_SFH)
+            out_Ia+= numpy.outer(Z_Ia,
+                                 -evol_Ia+tau_Ia_SFH
+                                 *(1./tau_Ia_SFH
+                                   -tau_dep_Ia/self._tau_dep_SFH
+                                   *(1.+expm1_dt_Ia_SFH)/tau_Ia_SFH
+                                   -(1.+self._tau_dep_SFH/tau_Ia_SFH
+                                     -tau_dep_Ia/self._tau_dep_SFH)
+                                   *(1.+expm1_dt_dep_SFH)/self._tau_dep_SFH))
+        out[:,idx]+= out_Ia/tIa
         return out
 
-    # Abundances
+    def _dlog10Z_dt(self,t,Z_CC_eq,Z_Ia_eq,Z_eq_floats):
+        # Analytic time derivative of log10(_Z_total)
+        return self._dZ_total_dt(t,Z_CC_eq,Z_Ia_eq,Z_eq_floats)\
+            /self._Z_total(t,Z_CC_eq,Z_Ia_eq,Z_eq_floats)/numpy.log(10.)
+
+    # Abundances; t can be a Quantity or a float or array in Gyr
     @_recalc_model
     def O_H(self,t):
-        # CCSNe contribution
-        ZO_t= self._ZO_CC_eq*self._evol_CC(t)
-        # Ia contribution
-        ZO_t+= self._ZO_Ia_eq*self._evol_Ia(t,
-                                            self._tau_dep_Ia,self._tau_Ia_SFH)
-        if not self.tau_Ia_2 is None:
-            ZO_t+= self._ZO_Ia_eq_2*self._evol_Ia(t,
-                                         self._tau_dep_Ia_2,self._tau_Ia_SFH_2)
+        ZO_t= self._Z_total(_as_gyr(t),*self._ZO_eq)[0]
         # DO WE NEED TO ADD HYDROGEN EVOLUTION AS WELL? SMALL EFFECT?
         return numpy.log10(ZO_t)-self._logZO_solar
 
     @_recalc_model
     def Fe_H(self,t):
-        # CCSNe contribution
-        ZFe_t= self._ZFe_CC_eq*self._evol_CC(t)
-        # Ia contribution
-        ZFe_t+= self._ZFe_Ia_eq*self._evol_Ia(t,
-                                             self._tau_dep_Ia,self._tau_Ia_SFH)
-        if not self.tau_Ia_2 is None:
-            ZFe_t+= self._ZFe_Ia_eq_2*self._evol_Ia(t,
-                                         self._tau_dep_Ia_2,self._tau_Ia_SFH_2)
+        ZFe_t= self._Z_total(_as_gyr(t),*self._ZFe_eq)[0]
         # DO WE NEED TO ADD HYDROGEN EVOLUTION AS WELL? SMALL EFFECT?
         return numpy.log10(ZFe_t)-self._logZFe_solar
 
+    @_recalc_model
+    def _all_abundances(self,t):
+        # [O/H], [Fe/H], and [O/Fe], evaluating the time evolution only once
+        # for both elements
+        ZO_t,ZFe_t= self._Z_total(_as_gyr(t),*self._Z_eq_all)
+        O_H= numpy.log10(ZO_t)-self._logZO_solar
+        Fe_H= numpy.log10(ZFe_t)-self._logZFe_solar
+        return (O_H,Fe_H,O_H-Fe_H)
+
     def O_Fe(self,t):
-        return self.O_H(t)-self.Fe_H(t)
+        return self._all_abundances(t)[2]
 
-    # MDFs of [Fe/H], [O/H], [O/Fe]
+    # Time derivatives of [Fe/H], [O/H], [O/Fe]; finite_diff= True uses a
+    # finite-difference approximation instead of the analytic derivative
     def _dX_dt(self,t,func):
-        if False:
-            pass
-        else:
-            dt= 1e-8*u.Gyr
-            return (func(t+dt)-func(t))/dt.to_value(u.Gyr)
+        t= _as_gyr(t)
+        dt= 1e-8
+        return (func(t+dt)-func(t))/dt
             
-    def dFe_H_dt(self,t):
-        return self._dX_dt(t,self.Fe_H)
+    @_recalc_model
+    def dFe_H_dt(self,t,finite_diff=False):
+        if finite_diff:
+            return self._dX_dt(t,self.Fe_H)
+        return self._dlog10Z_dt(_as_gyr(t),*self._ZFe_eq)[0]
 
-    def dO_H_dt(self,t):
-        return self._dX_dt(t,self.O_H)
+    @_recalc_model
+    def dO_H_dt(self,t,finite_diff=False):
+        if finite_diff:
+            return self._dX_dt(t,self.O_H)
+        return self._dlog10Z_dt(_as_gyr(t),*self._ZO_eq)[0]
 
-    def dO_Fe_dt(self,t):
-        return self._dX_dt(t,self.O_Fe)
+    @_recalc_model
+    def dO_Fe_dt(self,t,finite_diff=False):
+        if finite_diff:
+            return self._dX_dt(t,self.O_Fe)
+        t= _as_gyr(t)
+        dO_H_dt,dFe_H_dt= self._dlog10Z_dt(t,*self._Z_eq_all)
+        # Before the first Ias, O and Fe evolve identically and [O/Fe] is
+        # constant; set its derivative to exactly zero to avoid round-off
+        return numpy.where(t > self._min_dt_Ia_gyr,dO_H_dt-dFe_H_dt,0.)[()]
 
-    def _time(self,x,xfunc):
-        # Get the time at which xfunc reaches x (e.g., Fe/H(t) = x)
-        try:
-            return optimize.brentq(lambda t: x-xfunc(t*u.Gyr),1e-8,12.5)
-        except ValueError:
-            return numpy.NaN
-
-    def _XDF(self,x,func):
-        t= self._time(x,func)
-        if numpy.isnan(t): return 0.
-        if self.sfh.lower() == 'exp':
-            out= numpy.exp(-t*u.Gyr/self.tau_SFH)
+    # MDFs of [Fe/H], [O/H], [O/Fe]
+    def _build_inverse(self,xfunc,n=4096):
+        # Tabulate xfunc on a dense grid in time that can be interpolated to
+        # invert xfunc; the table is cached until the model changes and is
+        # None when xfunc is not monotonic
+        key= (self._current_model_hash,self.solar_O,self.solar_Fe)
+        if xfunc.__name__ in self._inverse_tables \
+                and self._inverse_tables[xfunc.__name__][0] == key:
+            return self._inverse_tables[xfunc.__name__][1]
+        t_grid= numpy.geomspace(1e-8,12.5,n)
+        x_grid= xfunc(t_grid)
+        if x_grid[-1] < x_grid[0]:
+            t_grid= t_grid[::-1]
+            x_grid= x_grid[::-1]
+        # Allow for round-off in flat parts (e.g., [O/Fe] before Ias)
+        if numpy.any(numpy.diff(x_grid) < -1e-10):
+            table= None
         else:
-            out= t*numpy.exp(-t*u.Gyr/self.tau_SFH)
-        out/= self._dX_dt(t*u.Gyr,func)
-        return out
+            table= (x_grid,numpy.log(t_grid))
+        self._inverse_tables[xfunc.__name__]= (key,table)
+        return table
+
+    def _time(self,x,xfunc,dxfunc,t0=1.,n_iter=15,tol=1e-10):
+        # Get the time at which xfunc reaches x (e.g., Fe/H(t) = x), NaN when
+        # it never does; x can be an array, for which all times are found
+        # simultaneously using Newton's method in log(t), starting from the
+        # interpolated table when available and from t0 otherwise
+        x= numpy.asarray(x,dtype='float64')
+        shape= x.shape
+        x= numpy.ravel(x)
+        table= self._build_inverse(xfunc)
+        if table is None:
+            log_t= numpy.full(x.shape,numpy.log(t0))
+        else:
+            log_t= numpy.interp(x,*table)
+        log_tmin, log_tmax= numpy.log(1e-8), numpy.log(12.5)
+        out= numpy.full(x.shape,numpy.nan)
+        todo= numpy.arange(len(x))
+        for ii in range(n_iter+1):
+            t= numpy.exp(log_t[todo])
+            dx= xfunc(t)-x[todo]
+            converged= numpy.fabs(dx) < tol
+            out[todo[converged]]= t[converged]
+            todo= todo[~converged]
+            if len(todo) == 0 or ii == n_iter: break
+            t= t[~converged]
+            dx= dx[~converged]
+            with numpy.errstate(divide='ignore',invalid='ignore'):
+                log_t[todo]-= dx/t/dxfunc(t)
+            # Keep within the time range; fmax/fmin also catch NaN steps
+            log_t[todo]= numpy.fmin(numpy.fmax(log_t[todo],log_tmin),
+                                    log_tmax)
+        return out.reshape(shape)
+
+    @_recalc_model
+    def _XDF(self,x,func,dfunc):
+        # MDFs of arrays are memoized in memory for the current model, keeping
+        # the _DF_CACHE_SIZE most recently used, and, when KIMMY_CACHE_DIR is
+        # set, on disk; single values are cheap to compute and are not cached
+        x= numpy.asarray(x,dtype='float64')
+        if x.ndim == 0:
+            return self._XDF_calc(x,func,dfunc)[()]
+        if self._DF_cache[0] != self._current_model_hash:
+            self._DF_cache= (self._current_model_hash,OrderedDict())
+        cache= self._DF_cache[1]
+        entry= '{}_{:x}'.format(func.__name__,
+                                _digest(struct.pack('2d',self.solar_O,
+                                                    self.solar_Fe)
+                                        +str(x.shape).encode()
+                                        +x.tobytes()))
+        if entry in cache:
+            cache.move_to_end(entry)
+        else:
+            filename= self._DF_cache_filename(entry)
+            out= self._load_DF(filename)
+            if out is None:
+                out= self._XDF_calc(x,func,dfunc)
+                self._save_DF(filename,out)
+            cache[entry]= out
+            if len(cache) > _DF_CACHE_SIZE:
+                cache.popitem(last=False)
+        return numpy.array(cache[entry])
+
+    def _XDF_calc(self,x,func,dfunc):
+        t= numpy.ravel(self._time(x,func,dfunc))
+        out= numpy.zeros(t.shape)
+        idx= ~numpy.isnan(t)
+        dxdt= dfunc(t[idx])
+        # Like times that cannot be found, flat parts of the track (e.g.,
+        # [O/Fe] before Ias) have zero density
+        idx[idx]= dxdt != 0.
+        dxdt= dxdt[dxdt != 0.]
+        t= t[idx]
+        if self._sfh_is_exp:
+            out[idx]= numpy.exp(-t/self._tau_SFH_gyr)
+        else:
+            out[idx]= t*numpy.exp(-t/self._tau_SFH_gyr)
+        out[idx]/= dxdt
+        return out.reshape(x.shape)
+
+    def _DF_cache_filename(self,entry):
+        # On-disk cache of one MDF, stored per version of kimmy and of the
+        # cache format and per model; only used with xxhash, because only its
+        # digests are stable between sessions
+        cache_dir= os.environ.get('KIMMY_CACHE_DIR')
+        if cache_dir is None or not _XXHASH_LOADED: return None
+        return os.path.join(cache_dir,
+                            '{}-{}'.format(__version__,_DF_CACHE_FORMAT),
+                            '{:x}'.format(self._current_model_hash),
+                            '{}.npy'.format(entry))
+
+    def _load_DF(self,filename):
+        if filename is None: return None
+        try:
+            return numpy.load(filename)
+        except (OSError,ValueError,EOFError):
+            return None
+
+    def _save_DF(self,filename,out):
+        # Write to a temporary file first, such that other processes never
+        # read a partially-written file
+        if filename is None: return None
+        tmpfilename= '{}.{}.tmp'.format(filename,os.getpid())
+        try:
+            os.makedirs(os.path.dirname(filename),exist_ok=True)
+            with open(tmpfilename,'wb') as tmpfile:
+                numpy.save(tmpfile,out)
+            os.replace(tmpfilename,filename)
+        except OSError: # pragma: no cover
+            pass
+        return None
 
     def Fe_H_DF(self,FeH):
-        return self._XDF(FeH,self.Fe_H)
+        return self._XDF(FeH,self.Fe_H,self.dFe_H_dt)
 
     def O_H_DF(self,OH):
-        return self._XDF(OH,self.O_H)
+        return self._XDF(OH,self.O_H,self.dO_H_dt)
 
     def O_Fe_DF(self,OFe):
-        return -self._XDF(OFe,self.O_Fe)
+        return -self._XDF(OFe,self.O_Fe,self.dO_Fe_dt)
 
     def _model_hash(self):
-        return hashlib.md5(numpy.array([self.eta,
-                                        self.tau_SFE.to(u.Gyr).value,
-                                        self.tau_SFH.to(u.Gyr).value,
-                                        self.tau_Ia.to(u.Gyr).value,
-                                        self.min_dt_Ia.to(u.Gyr).value,
-                                        self.mCC_O,
-                                        self.mCC_Fe,
-                                        self.mIa_O,
-                                        self.mIa_Fe,
-                                        self.r,
-              0 if self.tau_Ia_2 is None else self.tau_Ia_2.to(u.Gyr).value,
-                                        self.frac_Ia_2])).hexdigest()
-
-    def _solar_hash(self):
-        return hashlib.md5(numpy.array([self.solar_O,
-                                        self.solar_Fe])).hexdigest()
-
+        # Integer digest of the model parameters, using xxhash when available
+        params= (self.eta,
+                 self.tau_SFE.to_value(u.Gyr),
+                 self.tau_SFH.to_value(u.Gyr),
+                 self.tau_Ia.to_value(u.Gyr),
+                 self.min_dt_Ia.to_value(u.Gyr),
+                 self.mCC_O,
+                 self.mCC_Fe,
+                 self.mIa_O,
+                 self.mIa_Fe,
+                 self.r,
+                 0 if self.tau_Ia_2 is None else self.tau_Ia_2.to_value(u.Gyr),
+                 self.frac_Ia_2)
+        return _digest(struct.pack('12d',*params)+self.sfh.encode())
@@ -0,0 +1,51 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+# _kernels.pyx: ahead-of-time compiled kernels for the total abundances of
+#               elements in OneZone, the same as the numba kernels in
+#               OneZone.py; t is a 1D array, Z_CC_eq is an array over
+#               elements, Z_Ia_eq is a 2D array over elements and Ia
+#               components, tau_dep_Ia and tau_Ia_SFH are arrays over Ia
+#               components, and all times are in Gyr
+import numpy
+from libc.math cimport expm1
+def Z_total_exp(const double[::1] t,double min_dt_Ia,double tau_dep_SFH,
+                const double[::1] Z_CC_eq,const double[:,::1] Z_Ia_eq,
+                const double[::1] tau_dep_Ia,const double[::1] tau_Ia_SFH):
+    cdef Py_ssize_t ii, jj, kk
+    cdef double dt, expm1_dep_SFH, evol_CC, evol_Ia
+    cdef double[:,::1] out= numpy.empty((Z_CC_eq.shape[0],t.shape[0]))
+    for ii in range(t.shape[0]):
+        evol_CC= -expm1(-t[ii]/tau_dep_SFH)
+        for kk in range(Z_CC_eq.shape[0]):
+            out[kk,ii]= Z_CC_eq[kk]*evol_CC
+        dt= t[ii]-min_dt_Ia
+        if dt > 0.:
+            expm1_dep_SFH= expm1(-dt/tau_dep_SFH)
+            for jj in range(Z_Ia_eq.shape[1]):
+                evol_Ia= -expm1_dep_SFH-tau_dep_Ia[jj]/tau_dep_SFH\
+                    *(expm1(-dt/tau_Ia_SFH[jj])-expm1_dep_SFH)
+                for kk in range(Z_CC_eq.shape[0]):
+                    out[kk,ii]+= Z_Ia_eq[kk,jj]*evol_Ia
+    return out.base
+
+def Z_total_linexp(const double[::1] t,double min_dt_Ia,double tau_dep_SFH,
+                   const double[::1] Z_CC_eq,const double[:,::1] Z_Ia_eq,
+                   const double[::1] tau_dep_Ia,const double[::1] tau_Ia_SFH):
+    cdef Py_ssize_t ii, jj, kk
+    cdef double dt, expm1_dep_SFH, evol_CC, evol_Ia
+    cdef double[:,::1] out= numpy.empty((Z_CC_eq.shape[0],t.shape[0]))
+    for ii in range(t.shape[0]):
+        evol_CC= 1.+tau_dep_SFH/t[ii]*expm1(-t[ii]/tau_dep_SFH)
+        for kk in range(Z_CC_eq.shape[0]):
+            out[kk,ii]= Z_CC_eq[kk]*evol_CC
+        dt= t[ii]-min_dt_Ia
+        if dt > 0.:
+            expm1_dep_SFH= expm1(-dt/tau_dep_SFH)
+            for jj in range(Z_Ia_eq.shape[1]):
+                evol_Ia= tau_Ia_SFH[jj]/t[ii]\
+                    *(dt/tau_Ia_SFH[jj]+tau_dep_Ia[jj]/tau_dep_SFH
+                      *expm1(-dt/tau_Ia_SFH[jj])
+                      +(1.+tau_dep_SFH/tau_Ia_SFH[jj]
+                        -tau_dep_Ia[jj]/tau_dep_SFH)*expm1_dep_SFH)
+                for kk in range(Z_CC_eq.shape[0]):
+                    out[kk,ii]+= Z_Ia_eq[kk,jj]*evol_Ia
+    return out.base
@@ -1,4 +1,4 @@
-from setuptools import setup
+from setuptools import setup, Extension
     
 long_description= ''
 previous_line= ''
@@ -7,6 +7,17 @@ with open('README.md') as dfile:
         if '[!' in line: continue
         long_description+= line
 
+# Optional ahead-of-time compiled kernels, kimmy falls back to numba or numpy
+# when Cython is not available or the extension fails to build
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules= []
+else:
+    ext_modules= cythonize([Extension('kimmy._kernels',
+                                      sources=['kimmy/_kernels.pyx'],
+                                      optional=True)])
+
 setup(name='kimmy',
       version='0.2.dev',
       description='Chemical evolution in galaxies',
@@ -20,5 +31,6 @@ setup(name='kimmy',
       packages=['kimmy'],
       package_data={"": ["README.md","LICENSE"]},
       include_package_data=True,
+      ext_modules=ext_modules,
       install_requires=['numpy','astropy']
       )
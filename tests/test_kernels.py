@@ -0,0 +1,74 @@
+# test_kernels.py: check that all implementations of the abundance kernels
+#                  (numpy, scalar, numba, Cython) agree
+import importlib
+import numpy
+import pytest
+from astropy import units as u
+import kimmy
+onezone_module= importlib.import_module('kimmy.OneZone')
+
+# Times in Gyr, including t=0 and times before the minimum Ia delay
+ts= numpy.array([0.,0.01,0.1,0.15,0.16,0.5,1.,3.,7.,12.5])
+
+@pytest.fixture(params=[{},
+                        {'sfh':'linexp'},
+                        {'tau_Ia_2':3.*u.Gyr},
+                        {'sfh':'linexp','tau_Ia_2':3.*u.Gyr,'mIa_O':0.002}],
+                ids=['exp','linexp','exp-Ia2','linexp-Ia2'])
+def oz(request):
+    oz= kimmy.OneZone(**request.param)
+    oz.Fe_H(1.) # computes the model
+    return oz
+
+def _compiled_args(oz):
+    return (ts,oz._min_dt_Ia_gyr,oz._tau_dep_SFH,*oz._Z_eq_all[:2],
+            oz._tau_dep_Ia_all,oz._tau_Ia_SFH_all)
+
+def _numpy_Z_total(oz,monkeypatch):
+    monkeypatch.setattr(onezone_module,'_Z_total_exp_kernel',None)
+    monkeypatch.setattr(onezone_module,'_Z_total_linexp_kernel',None)
+    return oz._Z_total_impl(ts,*oz._Z_eq_all[:2])
+
+def _check(out,expected):
+    assert out.shape == expected.shape
+    numpy.testing.assert_allclose(out,expected,rtol=1e-10,equal_nan=True)
+    return None
+
+@numpy.errstate(divide='ignore',invalid='ignore')
+def test_scalar(oz,monkeypatch):
+    out= numpy.array([oz._Z_total_scalar_impl(t,oz._Z_eq_all[2])
+                      for t in ts]).T
+    _check(out,_numpy_Z_total(oz,monkeypatch))
+    return None
+
+@numpy.errstate(divide='ignore',invalid='ignore')
+def test_numba(oz,monkeypatch):
+    if not onezone_module._NUMBA_LOADED:
+        pytest.skip('numba is not installed')
+    if oz._sfh_is_exp:
+        out= onezone_module._Z_total_exp_jit(*_compiled_args(oz))
+    else:
+        out= onezone_module._Z_total_linexp_jit(*_compiled_args(oz))
+    _check(out,_numpy_Z_total(oz,monkeypatch))
+    return None
+
+@numpy.errstate(divide='ignore',invalid='ignore')
+def test_cython(oz,monkeypatch):
+    if not onezone_module._KERNELS_LOADED:
+        pytest.skip('Cython kernels are not compiled')
+    if oz._sfh_is_exp:
+        out= onezone_module._kernels.Z_total_exp(*_compiled_args(oz))
+    else:
+        out= onezone_module._kernels.Z_total_linexp(*_compiled_args(oz))
+    _check(out,_numpy_Z_total(oz,monkeypatch))
+    return None
+
+@numpy.errstate(divide='ignore',invalid='ignore')
+def test_public_api(oz,monkeypatch):
+    # Whichever kernel is used, the public functions agree with numpy
+    expected= oz.Fe_H(ts)
+    monkeypatch.setattr(onezone_module,'_Z_total_exp_kernel',None)
+    monkeypatch.setattr(onezone_module,'_Z_total_linexp_kernel',None)
+    numpy.testing.assert_allclose(oz.Fe_H(ts),expected,rtol=1e-10,
+                                  equal_nan=True)
+    return None
@@ -0,0 +1,157 @@
+# test_onezone.py: tests of the public OneZone interface
+import importlib
+import numpy
+import pytest
+from astropy import units as u
+import kimmy
+
+# Times in Gyr before and after the minimum Ia delay
+ts= numpy.array([0.05,0.1,0.2,0.5,1.,3.,7.,12.])
+
+@pytest.fixture(params=[{},
+                        {'sfh':'linexp'},
+                        {'tau_Ia_2':3.*u.Gyr},
+                        {'sfh':'linexp','tau_Ia_2':3.*u.Gyr,'mIa_O':0.002}],
+                ids=['exp','linexp','exp-Ia2','linexp-Ia2'])
+def oz(request):
+    return kimmy.OneZone(**request.param)
+
+def test_derivatives_finite_diff(oz):
+    # Analytic time derivatives agree with finite differences
+    for dfunc in [oz.dFe_H_dt,oz.dO_H_dt,oz.dO_Fe_dt]:
+        numpy.testing.assert_allclose(dfunc(ts),dfunc(ts,finite_diff=True),
+                                      rtol=1e-5,atol=1e-6)
+    return None
+
+def _sfh(oz,t):
+    if oz.sfh.lower() == 'exp':
+        return numpy.exp(-t/oz.tau_SFH.to_value(u.Gyr))
+    return t*numpy.exp(-t/oz.tau_SFH.to_value(u.Gyr))
+
+def test_DF_array_vs_scalar(oz):
+    # MDFs of arrays are the same as those of the individual values
+    for xdf,xs in [(oz.Fe_H_DF,numpy.linspace(-1.5,0.3,15)),
+                   (oz.O_H_DF,numpy.linspace(-1.,0.3,15)),
+                   (oz.O_Fe_DF,numpy.linspace(-0.2,0.4,15))]:
+        numpy.testing.assert_allclose(xdf(xs),[xdf(x) for x in xs],
+                                      rtol=1e-8)
+    return None
+
+def test_DF_track(oz):
+    # MDFs along the track are the SFH divided by the rate of change of the
+    # abundance; use times past the [O/Fe] plateau and before [O/H] flattens
+    tts= numpy.array([0.3,0.5,1.,2.,3.])
+    for func,xdf,dfunc,sign in [(oz.Fe_H,oz.Fe_H_DF,oz.dFe_H_dt,1.),
+                                (oz.O_H,oz.O_H_DF,oz.dO_H_dt,1.),
+                                (oz.O_Fe,oz.O_Fe_DF,oz.dO_Fe_dt,-1.)]:
+        numpy.testing.assert_allclose(\
+            xdf(func(tts)),
+            sign*_sfh(oz,tts)/dfunc(tts),rtol=1e-5)
+    return None
+
+def test_DF_plateau(oz):
+    # [O/Fe] is flat before the first Ias, which gives zero density
+    assert oz.O_Fe_DF(oz.O_Fe(0.1)) == 0.
+    return None
+
+def test_DF_outside_track(oz):
+    # Abundances that the model never reaches have zero density
+    assert numpy.all(oz.Fe_H_DF(numpy.array([5.,10.])) == 0.)
+    assert numpy.all(oz.O_H_DF(numpy.array([5.,10.])) == 0.)
+    assert oz.O_Fe_DF(2.) == 0.
+    return None
+
+def test_parameter_changes():
+    # Setting parameters re-computes the model, and initial() and default()
+    # restore the initial and default models
+    oz= kimmy.OneZone(eta=1.)
+    initial= oz.Fe_H(ts)
+    default= kimmy.OneZone().Fe_H(ts)
+    for key,value in [('eta',2.),('sfh','linexp'),('tau_SFE',2.*u.Gyr),
+                      ('tau_Ia_2',3.*u.Gyr)]:
+        setattr(oz,key,value)
+        new= oz.Fe_H(ts)
+        assert not numpy.allclose(new,initial), \
+            'Setting {} does not change the model'.format(key)
+        oz.initial()
+        numpy.testing.assert_allclose(oz.Fe_H(ts),initial,rtol=1e-12)
+        setattr(oz,key,value)
+        oz.default()
+        numpy.testing.assert_allclose(oz.Fe_H(ts),default,rtol=1e-12)
+        oz.initial()
+    return None
+
+def test_inplace_change_other_instance():
+    # Changing a parameter in place does not affect other instances
+    oz1= kimmy.OneZone()
+    oz2= kimmy.OneZone()
+    expected= oz2.Fe_H(ts)
+    oz1.tau_SFE*= 2
+    assert oz2.tau_SFE == 1.*u.Gyr
+    numpy.testing.assert_allclose(oz2.Fe_H(ts),expected,rtol=1e-12)
+    numpy.testing.assert_allclose(oz1.Fe_H(ts),
+                                  kimmy.OneZone(tau_SFE=2.*u.Gyr).Fe_H(ts),
+                                  rtol=1e-12)
+    # Nor the initial or default parameters
+    oz1.initial()
+    numpy.testing.assert_allclose(oz1.Fe_H(ts),expected,rtol=1e-12)
+    oz1.tau_SFE*= 2
+    oz1.default()
+    numpy.testing.assert_allclose(oz1.Fe_H(ts),expected,rtol=1e-12)
+    return None
+
+def test_solar_changes():
+    # Setting the solar abundances shifts the abundances without changing
+    # the model, and initial() restores them
+    oz= kimmy.OneZone()
+    FeH, OH= oz.Fe_H(ts), oz.O_H(ts)
+    oz.solar_Fe+= 0.1
+    numpy.testing.assert_allclose(oz.Fe_H(ts),FeH-0.1,rtol=1e-12)
+    numpy.testing.assert_allclose(oz.O_H(ts),OH,rtol=1e-12)
+    numpy.testing.assert_allclose(oz.O_Fe(ts),OH-FeH+0.1,rtol=1e-12)
+    oz.solar_O-= 0.2
+    numpy.testing.assert_allclose(oz.O_H(ts),OH+0.2,rtol=1e-12)
+    oz.initial()
+    numpy.testing.assert_allclose(oz.Fe_H(ts),FeH,rtol=1e-12)
+    numpy.testing.assert_allclose(oz.O_H(ts),OH,rtol=1e-12)
+    return None
+
+def test_time_inputs(oz):
+    # Times can be floats or arrays in Gyr or Quantities in any time unit
+    for func in [oz.Fe_H,oz.O_H,oz.O_Fe,oz.dFe_H_dt,oz.dO_H_dt,oz.dO_Fe_dt]:
+        expected= func(1.*u.Gyr)
+        numpy.testing.assert_allclose(func(1.),expected,rtol=1e-12)
+        numpy.testing.assert_allclose(func(1),expected,rtol=1e-12)
+        numpy.testing.assert_allclose(func(1000.*u.Myr),expected,rtol=1e-12)
+        expected= func(ts*u.Gyr)
+        numpy.testing.assert_allclose(func(ts),expected,rtol=1e-12)
+        numpy.testing.assert_allclose(func(list(ts)),expected,rtol=1e-12)
+        numpy.testing.assert_allclose(func(ts*1000.*u.Myr),expected,
+                                      rtol=1e-12)
+        assert func(ts.reshape(2,4)).shape == (2,4)
+    return None
+
+def test_DF_memory_cache_bounded():
+    # The in-memory cache of MDFs only keeps the most recently used ones
+    oz= kimmy.OneZone()
+    onezone_module= importlib.import_module('kimmy.OneZone')
+    for ii in range(onezone_module._DF_CACHE_SIZE+10):
+        oz.Fe_H_DF(numpy.array([-0.5,-0.001*ii]))
+    assert len(oz._DF_cache[1]) == onezone_module._DF_CACHE_SIZE
+    return None
+
+def test_DF_disk_cache(tmp_path,monkeypatch):
+    # MDFs are cached on disk when KIMMY_CACHE_DIR is set, such that they
+    # are read back by new instances
+    onezone_module= importlib.import_module('kimmy.OneZone')
+    if not onezone_module._XXHASH_LOADED:
+        pytest.skip('xxhash is not installed')
+    monkeypatch.setenv('KIMMY_CACHE_DIR',str(tmp_path))
+    FeHs= numpy.linspace(-1.5,0.3,15)
+    expected= kimmy.OneZone().Fe_H_DF(FeHs)
+    assert len(list(tmp_path.glob('**/*.npy'))) == 1
+    def no_calc(*args,**kwargs):
+        raise AssertionError('MDF was re-computed instead of read from disk')
+    monkeypatch.setattr(kimmy.OneZone,'_XDF_calc',no_calc)
+    numpy.testing.assert_array_equal(kimmy.OneZone().Fe_H_DF(FeHs),expected)
+    return None